@@ -8,56 +8,44 @@ Description:    This module launches a local server
 Created by:     P.L. Harvey
 LICENSE:        Apache2.0
 Copyright:      2024, P.L. Harvey
-Modified on:    20241120
+Modified on:    20261014
 """
 from datetime import datetime
+import os
 from sys import exit as sysexit
 from sys import stderr
-from random import randint
-from socket import error as socket_error
 from socket import socket, AF_INET, SOCK_STREAM
 import uvicorn
 
-def find_available_port() -> int:
+def bind_available_port() -> socket:
     """
-    Find an available port on the local machine.
+    Bind a socket to an available port on the local machine.
 
-    This function will keep trying different ports
-    above 8000 until it finds one that is available.
-    It uses a random port above 8000 to avoid conflicts
-    with other services that may be using lower ports.
+    Binding to port 0 lets the kernel pick a free
+    ephemeral port in a single call, instead of
+    probing random ports until one happens to be free.
+    The socket stays bound and is handed to uvicorn, so no
+    other process can take the port in between.
 
     Returns:
-        int: The available port number
+        socket: The bound socket
     """
-    while True:
-        # Choose a random port above 8000
-        port = 8000 + randint(0, 65535)
-
-        try:
-            # Create a socket and bind it to the chosen port
-            sock = socket(AF_INET,
-                          SOCK_STREAM)
-
-            sock.bind(("127.0.0.1",
-                       port))
-
-            # If the binding is successful,
-            # and return the port number
-            sock.close()
-            return port
-
-        except socket_error:
-            # If there's an error,
-            # try again with a new port
-            pass
+    sock = socket(AF_INET,
+                  SOCK_STREAM)
+    try:
+        sock.bind(("0.0.0.0",
+                   0))
+    except OSError:
+        sock.close()
+        raise
+    return sock
 
 def run_server() -> None:
     """
     Run the server using Uvicorn.
 
-    This function will start the server on a randomly
-    chosen available port and print out a message
+    This function will start the server on a
+    kernel-assigned available port and print out a message
     indicating which port is being used.
 
     Returns:
@@ -68,14 +56,28 @@ def run_server() -> None:
         start_time: datetime = datetime.now()
 
         # Find an available port
-        port: int = find_available_port()
+        sock: socket = bind_available_port()
+        port: int = sock.getsockname()[1]
 
-        # Run Uvicorn with the chosen port and reload=True
-        # to automatically restart if changes are made to the app code
-        uvicorn.run("main:app",
-                    host = "127.0.0.1",
-                    reload = True,
-                    port = port)
+        if os.environ.get("SHYLLM_DEV"):
+            # Automatically restart if changes are made to the
+            # app code. The reloader binds the port itself in
+            # its own process, so the socket is released first.
+            sock.close()
+            uvicorn.run("main:app",
+                        host = "0.0.0.0",
+                        port = port,
+                        loop = "uvloop",
+                        http = "httptools",
+                        reload = True)
+        else:
+            # Serve on the bound socket with the C-accelerated
+            # uvloop event loop and httptools HTTP parser.
+            config = uvicorn.Config("main:app",
+                                    loop = "uvloop",
+                                    http = "httptools",
+                                    workers = 1)
+            uvicorn.Server(config).run(sockets = [sock])
 
         # Record the end time of the server
         end_time: datetime = datetime.now()
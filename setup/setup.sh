@@ -1,2 +1,2 @@
-pip install fastapi uvicorn transformers pydantic python-multipart sentence-transformers
+pip install fastapi "uvicorn[standard]" orjson transformers pydantic python-multipart sentence-transformers
 pip install torch  # or tensorflow
@@ -10,7 +10,7 @@ Created by:     P.L. Harvey
 LICENSE:        Apache2.0
 Copyright:      2024, P.L. Harvey
 
-Modified on:    20241120
+Modified on:    20261014
 """
 import subprocess
 from logging import Logger, getLogger, basicConfig, INFO
@@ -41,7 +41,9 @@ app = FastAPI()
 # Replace with your desired model
 # TODO: preload a lightweight and reliable model into
 #       the docker container.
-MODEL_NAME = "bartowski/Llama-3.2-3B-Instruct-GGUF"
+# AutoModelForCausalLM cannot load GGUF repositories; use a
+# transformers checkpoint here. GGUF models are served by 0.0.2.
+MODEL_NAME = "Qwen/Qwen2.5-3B-Instruct"
 logger.info("Loading model: %s",
             MODEL_NAME)
 
@@ -176,7 +178,7 @@ async def stream_text(query: Query):
             content = output[0]["generated_text"],
             media_type = "text/plain")
         
-        return await response
+        return response
     
     except Exception as e:
         raise HTTPException(
@@ -12,18 +12,57 @@ Created by:     P.L. Harvey
 LICENSE:        Apache2.0
 Copyright:      2024, P.L. Harvey
 
-Modified on:    20241120  (Update with current date when modifying)
+Modified on:    20261014  (Update with current date when modifying)
 """
-from functools import lru_cache
-from logging import Logger, getLogger, basicConfig, INFO
 import os
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, field_validator, ValidationError
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
-from transformers.pipelines.base import Pipeline
+
+# --- CPU Threading ---
+
+# Size the OpenMP/MKL thread pools before torch and transformers
+# create them. Left to their defaults, every pool claims all cores
+# and they oversubscribe the CPU, which can make quantized CPU
+# inference slower than float32.
+os.environ.setdefault("OMP_NUM_THREADS",
+                      str((os.cpu_count() or 2) // 2 or 1))
+os.environ.setdefault("MKL_NUM_THREADS",
+                      os.environ["OMP_NUM_THREADS"])
+
+import asyncio
+from collections.abc import AsyncIterator, Callable, Iterator
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache, partial
+import gc
+import hmac
+from importlib.util import find_spec
+from logging import Logger, getLogger, basicConfig, INFO
+from queue import Queue
+import threading
+from typing import TYPE_CHECKING
+from uuid import uuid4
+import torch
+from fastapi import Depends, FastAPI, HTTPException, Request, Security
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.security import APIKeyHeader
+from pydantic import BaseModel, Field, PositiveInt, constr
+from starlette.types import Receive, Scope, Send
+from transformers import (AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig,
+                          CompileConfig, PreTrainedModel, StoppingCriteria,
+                          StoppingCriteriaList, TextIteratorStreamer)
 from transformers.tokenization_utils import PreTrainedTokenizer
 from transformers.tokenization_utils_fast import PreTrainedTokenizerFast
 
+if TYPE_CHECKING:
+    from llama_cpp import Llama
+    from optimum.onnxruntime import ORTModelForCausalLM
+    from vllm import AsyncLLMEngine, SamplingParams
+
+# Threads used for CPU inference, shared by torch and llama.cpp.
+NUM_THREADS: int = int(os.environ["OMP_NUM_THREADS"])
+torch.set_num_threads(NUM_THREADS)
+torch.set_num_interop_threads(1)
+
 # --- Configuration ---
 
 # Retrieve environment variables for model name and API key.
@@ -35,6 +74,52 @@ MODEL_NAME: str = os.environ.get(
 # API key for authentication (optional).
 API_KEY: str | None = os.environ.get("SHYLLM_API_KEY")
 
+# Inference backend: "hf" runs transformers (or llama.cpp for GGUF
+# repositories) on micro-batched queries, "ort" runs the same path on
+# an ONNX Runtime export of the model, and "vllm" runs a shared
+# AsyncLLMEngine (PagedAttention KV cache and continuous batching
+# across concurrent requests).
+BACKEND: str = os.environ.get("SHYLLM_BACKEND", "hf").lower()
+
+# Where ONNX exports are kept between runs of the "ort" backend.
+ORT_CACHE: str = os.environ.get("SHYLLM_ORT_CACHE", "./cache/ort")
+
+# Weights file to fetch from GGUF repositories (glob pattern).
+GGUF_FILE: str = os.environ.get("SHYLLM_GGUF_FILE", "*Q4_K_M.gguf")
+
+# Concurrent /generate queries are coalesced into batches of up to
+# MAX_BATCH prompts, waiting at most BATCH_WAIT seconds for a batch to fill.
+MAX_BATCH: int = int(os.environ.get("SHYLLM_MAX_BATCH", "8"))
+BATCH_WAIT: float = int(os.environ.get("SHYLLM_BATCH_WAIT_MS", "10")) / 1000
+
+# Weight quantization for transformers models: "none" (half precision
+# on GPU), "nf4" or "int8" (bitsandbytes, for memory-constrained GPUs)
+# or "awq" (load the model's prequantized AWQ variant instead).
+QUANT: str = os.environ.get("SHYLLM_QUANT", "none").lower()
+if QUANT not in ("none", "nf4", "int8", "awq"):
+    raise ValueError(
+        f"SHYLLM_QUANT must be one of none, nf4, int8 or awq, not {QUANT!r}."
+        )
+# Only transformers models on the "hf" backend read QUANT; GGUF
+# weights are quantized already and the other backends load their own.
+if QUANT != "none" and BACKEND != "hf":
+    raise ValueError(
+        f"SHYLLM_QUANT={QUANT} is not supported on the {BACKEND} backend."
+        )
+if QUANT != "none" and "GGUF" in MODEL_NAME.upper():
+    raise ValueError(
+        f"SHYLLM_QUANT={QUANT} does not apply to GGUF models, which are already quantized."
+        )
+# bitsandbytes and AWQ kernels only run on CUDA.
+if QUANT != "none" and not torch.cuda.is_available():
+    raise ValueError(
+        f"SHYLLM_QUANT={QUANT} needs a CUDA GPU; use a GGUF model on CPU hosts."
+        )
+
+# Compile the decode step with torch.compile on GPU hosts
+# (set SHYLLM_COMPILE=0 to disable).
+COMPILE: bool = os.environ.get("SHYLLM_COMPILE", "1") != "0"
+
 # --- Logging Setup ---
 
 # Set the basic logging level to INFO.
@@ -43,84 +128,838 @@ basicConfig(level = INFO)
 # Get a logger instance for this module.
 logger: Logger = getLogger(__name__)
 
-# --- FastAPI App Initialization ---
+# --- Model Loading ---
 
-# Create a FastAPI application instance.
-app = FastAPI()
+class StopWhenSet(StoppingCriteria):
+    """
+    Stops generation once an event is set.
+    """
+    def __init__(self, stopped: threading.Event):
+        self.stopped = stopped
 
-# --- Model Loading ---
+    def __call__(self,
+                 input_ids: torch.LongTensor,
+                 scores: torch.FloatTensor,
+                 **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],),
+                          self.stopped.is_set(),
+                          dtype = torch.bool,
+                          device = input_ids.device)
+
+def until_closed(pieces: Iterator[str],
+                 stopped: threading.Event) -> Iterator[str]:
+    """
+    Yields from pieces, setting stopped once iteration ends.
+
+    The response closes the iterator when the client disconnects,
+    which tells the producer to stop generating text nobody reads.
+    """
+    try:
+        yield from pieces
+    finally:
+        stopped.set()
+
+class TransformersModel:
+    """
+    Generates text by calling model.generate on tokenized prompts,
+    without the pre/post-processing overhead of a pipeline.
+    """
+    def __init__(self,
+                 tokenizer: PreTrainedTokenizer | PreTrainedTokenizerFast,
+                 model: "PreTrainedModel | ORTModelForCausalLM",
+                 compiled: bool = False):
+        self.tokenizer = tokenizer
+        self.model = model
+        # Whether generate() runs a compiled decode step (see load_model).
+        self.compiled = compiled
+        # Measured when batching; repeated prompts skip tokenization.
+        self.prompt_length = lru_cache(maxsize = 1024)(self._count_tokens)
+
+    def _count_tokens(self, prompt: str) -> int:
+        return len(self.tokenizer(prompt,
+                                  add_special_tokens = False).input_ids)
+
+    def generate(self,
+                 prompts: list[str],
+                 max_new_tokens: int = 100,
+                 temperature: float = 1.0,
+                 top_p: float = 0.95) -> list[str]:
+        """
+        Generates a completion for each prompt as a single batch.
+
+        Args:
+            prompts (list[str]): The prompts to complete.
+            max_new_tokens (int): The maximum number of tokens to generate.
+            temperature (float): The sampling temperature.
+            top_p (float): The nucleus sampling threshold.
+
+        Returns:
+            list[str]: The completions, without the prompts, in prompt order.
+        """
+        inputs = self._encode(prompts)
+        output_ids = self.model.generate(
+            **inputs,
+            **self._sampling(max_new_tokens, temperature, top_p)
+            )
+        prompt_length = inputs["input_ids"].shape[1]
+        return self.tokenizer.batch_decode(output_ids[:, prompt_length:],
+                                           skip_special_tokens = True)
+
+    def stream(self,
+               prompt: str,
+               executor: Executor,
+               max_new_tokens: int = 100,
+               temperature: float = 1.0,
+               top_p: float = 0.95) -> Iterator[str]:
+        """
+        Streams the completion of a prompt as it is generated.
+
+        Args:
+            prompt (str): The prompt to complete.
+            executor (Executor): Where generation runs.
+            max_new_tokens (int): The maximum number of tokens to generate.
+            temperature (float): The sampling temperature.
+            top_p (float): The nucleus sampling threshold.
+
+        Returns:
+            Iterator[str]: The completion, piece by piece. Iterating
+            blocks until the next piece has been generated; closing
+            the iterator stops generation.
+        """
+        streamer = TextIteratorStreamer(self.tokenizer,
+                                        skip_prompt = True,
+                                        skip_special_tokens = True)
+        stopped = threading.Event()
+
+        def produce() -> None:
+            try:
+                inputs = self._encode([prompt])
+                self.model.generate(
+                    **inputs,
+                    **self._sampling(max_new_tokens, temperature, top_p),
+                    streamer = streamer,
+                    stopping_criteria = StoppingCriteriaList([StopWhenSet(stopped)])
+                    )
+            except Exception:
+                logger.exception("Error streaming text")
+                # Release the consumer waiting on the streamer.
+                streamer.end()
+
+        executor.submit(produce)
+        return until_closed(streamer, stopped)
+
+    def _encode(self, prompts: list[str]) -> dict[str, torch.Tensor]:
+        # One call tokenizes the whole batch in the Rust tokenizer;
+        # lengths padded to a multiple of 8 suit tensor core tiles.
+        inputs = self.tokenizer(prompts,
+                                padding = True,
+                                pad_to_multiple_of = 8,
+                                return_tensors = "pt")
+        # The token tensors are a few KB, so they are copied to the
+        # GPU directly; pinning them first would add a host copy.
+        return dict(inputs.to(self.model.device))
+
+    def _sampling(self,
+                  max_new_tokens: int,
+                  temperature: float,
+                  top_p: float) -> dict:
+        return {
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": True,
+            "use_cache": True,
+            "pad_token_id": self.tokenizer.pad_token_id,
+        }
+
+class LlamaCppModel:
+    """
+    Generates text with a llama.cpp model.
+    """
+    def __init__(self, llm: "Llama"):
+        self.llm = llm
+        self.prompt_length = lru_cache(maxsize = 1024)(self._count_tokens)
+
+    def _count_tokens(self, prompt: str) -> int:
+        return len(self.llm.tokenize(prompt.encode(),
+                                     add_bos = False))
+
+    def generate(self,
+                 prompts: list[str],
+                 max_new_tokens: int = 100,
+                 temperature: float = 1.0,
+                 top_p: float = 0.95) -> list[str]:
+        """
+        Generates a completion for each prompt.
+
+        llama.cpp decodes a single sequence with its own KV cache,
+        so the prompts are completed in turn.
+
+        Args:
+            prompts (list[str]): The prompts to complete.
+            max_new_tokens (int): The maximum number of tokens to generate.
+            temperature (float): The sampling temperature.
+            top_p (float): The nucleus sampling threshold.
+
+        Returns:
+            list[str]: The completions, without the prompts, in prompt order.
+        """
+        return [self.llm(prompt,
+                         max_tokens = max_new_tokens,
+                         temperature = temperature,
+                         top_p = top_p)["choices"][0]["text"]
+                for prompt in prompts]
+
+    def stream(self,
+               prompt: str,
+               executor: Executor,
+               max_new_tokens: int = 100,
+               temperature: float = 1.0,
+               top_p: float = 0.95) -> Iterator[str]:
+        """
+        Streams the completion of a prompt as it is generated.
+
+        Args:
+            prompt (str): The prompt to complete.
+            executor (Executor): Where generation runs.
+            max_new_tokens (int): The maximum number of tokens to generate.
+            temperature (float): The sampling temperature.
+            top_p (float): The nucleus sampling threshold.
+
+        Returns:
+            Iterator[str]: The completion, piece by piece. Iterating
+            blocks until the next piece has been generated; closing
+            the iterator stops generation.
+        """
+        chunks: Queue[str | None] = Queue()
+        stopped = threading.Event()
+
+        def produce() -> None:
+            try:
+                for chunk in self.llm(prompt,
+                                      max_tokens = max_new_tokens,
+                                      temperature = temperature,
+                                      top_p = top_p,
+                                      stream = True):
+                    if stopped.is_set():
+                        break
+                    chunks.put(chunk["choices"][0]["text"])
+            except Exception:
+                logger.exception("Error streaming text")
+            finally:
+                chunks.put(None)
+
+        executor.submit(produce)
+        return until_closed(iter(chunks.get, None), stopped)
+
+def load_gguf(model_name: str) -> LlamaCppModel:
+    """
+    Loads a GGUF quantized model with llama.cpp.
+
+    Args:
+        model_name (str): The HuggingFace repository holding the GGUF files.
+
+    Returns:
+        LlamaCppModel: A wrapper around the loaded model.
+    """
+    # llama-cpp-python is only required for GGUF repositories.
+    from llama_cpp import Llama
+
+    llm = Llama.from_pretrained(
+        repo_id = model_name,
+        filename = GGUF_FILE,
+        n_ctx = 4096,
+        n_threads = NUM_THREADS,
+        n_gpu_layers = -1 if torch.cuda.is_available() else 0
+        )
+    return LlamaCppModel(llm)
+
+def select_dtype() -> torch.dtype:
+    """
+    Picks the fastest floating point type the hardware supports.
+
+    Returns:
+        torch.dtype: bfloat16 on Ampere or newer GPUs, float16 on
+        older GPUs and float32 on CPU.
+    """
+    if not torch.cuda.is_available():
+        return torch.float32
+    if torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+def select_attention() -> str:
+    """
+    Picks the fastest attention kernel available.
+
+    Returns:
+        str: "flash_attention_2" when flash-attn is installed and a
+        GPU is present, otherwise "sdpa" (PyTorch scaled dot product
+        attention, which dispatches to fused kernels where it can).
+    """
+    if torch.cuda.is_available() and find_spec("flash_attn") is not None:
+        return "flash_attention_2"
+    return "sdpa"
+
+def awq_equivalent(model_name: str) -> str:
+    """
+    Names the prequantized AWQ variant of a model.
+
+    Args:
+        model_name (str): The name of the LLM model.
 
-# Cache the loaded model to improve performance.
-@lru_cache(maxsize = 1)
-def load_model(model_name: str) -> Pipeline:
+    Returns:
+        str: The repository of the AWQ variant, following the
+        "<model>-AWQ" naming used on HuggingFace.
+    """
+    if model_name.upper().endswith("-AWQ"):
+        return model_name
+    return f"{model_name}-AWQ"
+
+def quantization_config(dtype: torch.dtype) -> BitsAndBytesConfig | None:
+    """
+    Builds the bitsandbytes configuration selected by QUANT.
+
+    int8 saves memory but its decode is often slower than float16
+    at batch size 1; prefer nf4 or awq when speed matters.
+
+    Args:
+        dtype (torch.dtype): The dtype to compute in.
+
+    Returns:
+        BitsAndBytesConfig | None: The configuration, or None when
+        the weights are not quantized at load time.
+    """
+    if QUANT == "nf4":
+        return BitsAndBytesConfig(load_in_4bit = True,
+                                  bnb_4bit_quant_type = "nf4",
+                                  bnb_4bit_compute_dtype = dtype)
+    if QUANT == "int8":
+        return BitsAndBytesConfig(load_in_8bit = True)
+    return None
+
+def load_onnx(model_name: str) -> "ORTModelForCausalLM":
+    """
+    Loads the specified LLM model with ONNX Runtime.
+
+    The model is exported to ONNX on first use and the export is
+    saved under ORT_CACHE, so later starts skip the export.
+
+    Args:
+        model_name (str): The name of the LLM model to load.
+
+    Returns:
+        ORTModelForCausalLM: The model, with the same generate()
+        interface as a transformers model.
+    """
+    # optimum is only required when SHYLLM_BACKEND=ort.
+    from onnxruntime import get_available_providers
+    from optimum.onnxruntime import ORTModelForCausalLM
+
+    export_dir = os.path.join(ORT_CACHE, model_name.replace("/", "--"))
+    exported = os.path.isdir(export_dir)
+    # The CUDA provider is only present in the onnxruntime-gpu wheel,
+    # whatever torch reports. IO binding keeps inputs and outputs on
+    # the GPU between steps; it has no effect on the CPU provider.
+    cuda = "CUDAExecutionProvider" in get_available_providers()
+    model = ORTModelForCausalLM.from_pretrained(
+        export_dir if exported else model_name,
+        export = not exported,
+        provider = "CUDAExecutionProvider" if cuda else "CPUExecutionProvider",
+        use_io_binding = cuda
+        )
+    if not exported:
+        model.save_pretrained(export_dir)
+    return model
+
+def compiles() -> bool:
+    """
+    Tells whether transformers models are compiled with torch.compile.
+
+    Returns:
+        bool: True on GPU hosts running unquantized transformers
+        weights on the "hf" backend, unless SHYLLM_COMPILE=0.
+        bitsandbytes and AWQ layers call custom kernels that do not
+        compile, and GGUF models run on llama.cpp.
+    """
+    return (COMPILE
+            and BACKEND == "hf"
+            and QUANT == "none"
+            and "GGUF" not in MODEL_NAME.upper()
+            and torch.cuda.is_available())
+
+def load_model(model_name: str) -> TransformersModel | LlamaCppModel:
     """
     Loads the specified LLM model and tokenizer.
 
+    GGUF repositories cannot be read by transformers and are
+    loaded with llama.cpp instead. With the "ort" backend the
+    model runs on ONNX Runtime (see load_onnx).
+
     Args:
         model_name (str): The name of the LLM model to load.
 
     Returns:
-        Pipeline: A transformers pipeline object for text generation.
+        TransformersModel | LlamaCppModel: The model, ready for generation.
 
     Raises:
         Exception: If the model fails to load. 
-        The exception is re-raised to be handled by the API endpoint.
+        The exception is re-raised and aborts server startup.
     """
     try:
+        if "GGUF" in model_name.upper():
+            return load_gguf(model_name)
+        if QUANT == "awq":
+            model_name = awq_equivalent(model_name)
         tokenizer: PreTrainedTokenizer | PreTrainedTokenizerFast = AutoTokenizer.from_pretrained(
             model_name
             )
+        # Batched prompts are left padded so every row of the
+        # batch ends where generation starts.
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        if BACKEND == "ort":
+            return TransformersModel(tokenizer, load_onnx(model_name))
+        dtype = select_dtype()
         model = AutoModelForCausalLM.from_pretrained(
-            model_name
+            model_name,
+            torch_dtype = dtype,
+            quantization_config = quantization_config(dtype),
+            attn_implementation = select_attention(),
+            device_map = "auto",
+            low_cpu_mem_usage = True
             )
-        return pipeline("text-generation",
-                        model = model,
-                        tokenizer = tokenizer)
+        # Models without static cache support fail in generate()
+        # when asked for one, so they run uncompiled.
+        compiled = compiles() and model._supports_static_cache
+        if compiled:
+            # With a static KV cache generate() compiles the decode
+            # step itself, keeping its shapes fixed so the CUDA graphs
+            # recorded by "reduce-overhead" are replayed. Prefill runs
+            # eagerly and does not recompile for each prompt length.
+            model.generation_config.cache_implementation = "static"
+            model.generation_config.compile_config = CompileConfig(
+                fullgraph = False,
+                mode = "reduce-overhead"
+                )
+        return TransformersModel(tokenizer, model, compiled)
     except Exception as e:
         logger.exception("Error loading model %s: %s",
                          model_name, e)
         raise
 
+def load_engine(model_name: str) -> "AsyncLLMEngine":
+    """
+    Loads the specified LLM model into a vLLM engine.
+
+    Args:
+        model_name (str): The name of the LLM model to load.
+
+    Returns:
+        AsyncLLMEngine: A vLLM engine shared by all requests.
+
+    Raises:
+        Exception: If the engine fails to start.
+        The exception is re-raised and aborts server startup.
+    """
+    # vLLM is only required when SHYLLM_BACKEND=vllm.
+    from vllm import AsyncEngineArgs, AsyncLLMEngine
+
+    try:
+        return AsyncLLMEngine.from_engine_args(
+            AsyncEngineArgs(
+                model = model_name,
+                # bfloat16 only where the GPU supports it (Ampere or
+                # newer), float16 on older GPUs such as V100 and T4.
+                dtype = str(select_dtype()).removeprefix("torch."),
+                max_num_seqs = 256,
+                gpu_memory_utilization = 0.9
+                )
+            )
+    except Exception as e:
+        logger.exception("Error starting engine for %s: %s",
+                         model_name, e)
+        raise
+
+# --- Model Instance ---
+
+# The one loaded model, shared by every request. Only swapped under _LOCK.
+_LLM: "TransformersModel | LlamaCppModel | AsyncLLMEngine | None" = None
+_LOCK = threading.Lock()
+
+# Why the last reload failed, if it did. No model is loaded until
+# the next reload succeeds.
+_LOAD_ERROR: Exception | None = None
+
+class ModelUnavailable(RuntimeError):
+    """
+    Raised when no model is loaded because the last reload failed.
+    """
+
+def _load(model_name: str) -> "TransformersModel | LlamaCppModel | AsyncLLMEngine":
+    logger.info("Loading model %s (%s backend)",
+                model_name, BACKEND)
+    if BACKEND == "vllm":
+        return load_engine(model_name)
+    return load_model(model_name)
+
+def get_model() -> "TransformersModel | LlamaCppModel | AsyncLLMEngine":
+    """
+    Returns the loaded model, loading MODEL_NAME on first use.
+
+    Blocks while the model is being loaded or reloaded, so the
+    server only calls it from the inference thread (see on_model).
+
+    Returns:
+        TransformersModel | LlamaCppModel | AsyncLLMEngine: The model.
+
+    Raises:
+        ModelUnavailable: If the last reload failed. Loading is not
+        retried here, so queued requests fail fast instead of each
+        starting another load; only /reload tries again.
+    """
+    global _LLM
+    with _LOCK:
+        if _LLM is None:
+            if _LOAD_ERROR is not None:
+                raise ModelUnavailable("The last reload failed.") from _LOAD_ERROR
+            _LLM = _load(MODEL_NAME)
+        return _LLM
+
+def reload_model() -> "TransformersModel | LlamaCppModel | AsyncLLMEngine":
+    """
+    Frees the loaded model and loads MODEL_NAME again.
+
+    The old model is released before the new one is loaded, so the
+    two are never resident in memory at the same time. Not used with
+    the vLLM backend, whose engine keeps its GPU memory reserved until
+    the process exits.
+
+    Returns:
+        TransformersModel | LlamaCppModel | AsyncLLMEngine: The new model.
+
+    Raises:
+        Exception: If the model fails to load. The failure is recorded
+        and get_model refuses requests until a reload succeeds.
+    """
+    global _LLM, _LOAD_ERROR
+    with _LOCK:
+        _LLM = None
+        if compiles():
+            # dynamo's compiled code and CUDA graph pool outlive the
+            # model and would keep its memory alive.
+            torch._dynamo.reset()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        try:
+            _LLM = _load(MODEL_NAME)
+        except Exception as e:
+            _LOAD_ERROR = e
+            raise
+        _LOAD_ERROR = None
+        return _LLM
+
+def warm_up(llm: "TransformersModel | LlamaCppModel | AsyncLLMEngine") -> None:
+    """
+    Generates a completion so first-use costs are paid now, on the
+    inference thread, rather than by the first request.
+
+    A compiled model is warmed up with a typical query, a prompt of
+    about 64 tokens and the default max_length, so compilation and
+    CUDA graph capture of the decode step happen here. Other models only
+    need a few tokens. vLLM engines need no warm-up.
+    """
+    if BACKEND == "vllm":
+        return
+    if isinstance(llm, TransformersModel) and llm.compiled:
+        llm.generate([" ".join(["warmup"] * 64)],
+                     max_new_tokens = Query.model_fields["max_length"].default)
+    else:
+        llm.generate(["warmup"],
+                     max_new_tokens = 8)
+
+
+def log_batcher_exit(task: asyncio.Task) -> None:
+    """
+    Logs the batcher task stopping for any reason but shutdown,
+    since /generate cannot be served without it.
+    """
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Batcher stopped; /generate will not respond",
+                     exc_info = task.exception())
+
+# --- FastAPI App Initialization ---
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Loads the model before the server starts accepting requests.
+
+    Blocking inference runs on a single worker thread so the
+    event loop stays free; one worker because the model is not
+    safe to call from several threads at once. Queries reach that
+    thread in batches through app.state.inbox (see batch_queries).
+    """
+    app.state.pool = ThreadPoolExecutor(max_workers = 1)
+    await on_model(app, warm_up)
+    batcher = None
+    if BACKEND != "vllm":
+        # vLLM batches concurrent requests itself.
+        app.state.inbox = asyncio.Queue()
+        batcher = asyncio.create_task(batch_queries(app))
+        batcher.add_done_callback(log_batcher_exit)
+    yield
+    if batcher is not None:
+        batcher.cancel()
+    app.state.pool.shutdown(wait = False, cancel_futures = True)
+
+# Create a FastAPI application instance.
+app = FastAPI(lifespan = lifespan,
+              default_response_class = ORJSONResponse)
+
+class GZipExceptStream(GZipMiddleware):
+    """
+    Compresses responses like GZipMiddleware, except those of /stream.
+
+    gzip holds output back until it has a full block to compress,
+    which would delay every streamed token.
+    """
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"] == "/stream":
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# Compress long generated responses for clients that accept gzip.
+app.add_middleware(GZipExceptStream,
+                   minimum_size = 512)
 
 # --- Request Data Model ---
 
 class Query(BaseModel):
     """
     Represents the input query for text generation.
+
+    The prompt is stripped and must not be empty, max_length must be
+    a positive integer, temperature must lie in (0, 2] and top_p in (0, 1].
     """
-    prompt: str
-    max_length: int = 100
-    temperature: float = 1.0
-    top_p: float = 0.95
+    prompt: constr(strip_whitespace = True, min_length = 1)
+    max_length: PositiveInt = 100
+    temperature: float = Field(1.0, gt = 0, le = 2)
+    top_p: float = Field(0.95, gt = 0, le = 1)
 
-    @field_validator("prompt")
-    def prompt_not_empty(cls, v):
-        """
-        Validates that the prompt is not empty.
-        """
-        errors = []
-        if not v:
-            errors.append(ValueError("Prompt cannot be empty"))
-        if not isinstance(v, str):
-            errors.append(TypeError("Prompt must be a string"))
-        if errors:
-            raise ValidationError(errors, cls)
-        return v.strip()
-
-    @field_validator("max_length")
-    def validate_max_length(cls, v) -> int:
-        """
-        Validates that max_length is a strictly pos. integer.
-        """
-        if not isinstance(v, int) or v <= 0:
-            raise ValidationError(
-                [ValueError("max_length must be a positive integer")],
-                cls
+# --- Generation ---
+
+async def on_model(app: FastAPI, work: Callable):
+    """
+    Calls work(model) on the inference thread.
+
+    The model is looked up on that thread as well, so a request that
+    arrives during a reload waits there instead of blocking the
+    event loop.
+
+    Args:
+        app (FastAPI): The application holding the worker pool.
+        work (Callable): Called with the loaded model.
+
+    Returns:
+        Whatever work returns.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        app.state.pool,
+        lambda: work(get_model())
+        )
+
+async def generate_with_engine(engine: "AsyncLLMEngine",
+                               query: Query) -> str:
+    """
+    Generates a completion for the query on a vLLM engine.
+
+    Args:
+        engine (AsyncLLMEngine): The engine returned by load_engine.
+        query (Query): The input query containing the prompt and parameters.
+
+    Returns:
+        str: The generated completion, without the prompt.
+    """
+    final = None
+    async for output in engine.generate(query.prompt,
+                                        engine_sampling(query),
+                                        request_id = uuid4().hex):
+        final = output
+    return final.outputs[0].text
+
+async def stream_with_engine(engine: "AsyncLLMEngine",
+                             query: Query) -> AsyncIterator[str]:
+    """
+    Streams the completion for the query from a vLLM engine.
+
+    Args:
+        engine (AsyncLLMEngine): The engine returned by load_engine.
+        query (Query): The input query containing the prompt and parameters.
+
+    Yields:
+        str: Each newly generated piece of the completion.
+    """
+    sent = 0
+    async for output in engine.generate(query.prompt,
+                                        engine_sampling(query),
+                                        request_id = uuid4().hex):
+        # vLLM reports the whole completion so far; send what is new.
+        text = output.outputs[0].text
+        yield text[sent:]
+        sent = len(text)
+
+def engine_sampling(query: Query) -> "SamplingParams":
+    """
+    Converts the query's sampling parameters for vLLM.
+    """
+    from vllm import SamplingParams
+
+    return SamplingParams(
+        max_tokens = query.max_length,
+        temperature = query.temperature,
+        top_p = query.top_p,
+        )
+
+async def run_batch(app: FastAPI,
+                    batch: list[tuple[Query, asyncio.Future]]) -> None:
+    """
+    Runs one batch of queries through the model and resolves
+    each query's future with its generated text.
+
+    All queries in the batch must share the same sampling parameters.
+
+    Args:
+        app (FastAPI): The application holding the model and worker pool.
+        batch (list[tuple[Query, asyncio.Future]]): The queries to run,
+        paired with the futures their endpoints are waiting on.
+    """
+    query, _ = batch[0]
+    prompts = [queued.prompt for queued, _ in batch]
+    try:
+        outputs = await on_model(
+            app,
+            lambda llm: llm.generate(
+                prompts,
+                max_new_tokens = query.max_length,
+                temperature = query.temperature,
+                top_p = query.top_p,
                 )
-        return v
+            )
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+
+    for (_, future), text in zip(batch, outputs):
+        # The client may have disconnected and cancelled the future.
+        if not future.done():
+            future.set_result(text)
+
+def bucket_by_length(llm: TransformersModel | LlamaCppModel,
+                     batch: list[tuple[Query, asyncio.Future]]) -> list[list]:
+    """
+    Splits a batch into buckets of similarly sized prompts.
+
+    Every prompt in a batch is padded to the longest one, so the
+    queries are sorted by prompt length and a new bucket is started
+    whenever a prompt is more than twice as long as the shortest
+    prompt of the current bucket.
+
+    Args:
+        llm (TransformersModel | LlamaCppModel): The model whose
+        tokenizer measures the prompts.
+        batch (list[tuple[Query, asyncio.Future]]): The queries to split.
+
+    Returns:
+        list[list]: The buckets, shortest prompts first.
+    """
+    measured = sorted(
+        ((max(llm.prompt_length(query.prompt), 1), (query, future))
+         for query, future in batch),
+        key = lambda pair: pair[0]
+        )
+    buckets: list[list] = []
+    shortest = 0
+    for length, item in measured:
+        if not buckets or length > 2 * shortest:
+            buckets.append([])
+            shortest = length
+        buckets[-1].append(item)
+    return buckets
+
+async def batch_queries(app: FastAPI) -> None:
+    """
+    Coalesces queued queries into batches for the model.
+
+    Waits for a query on app.state.inbox, then keeps collecting
+    for up to BATCH_WAIT seconds or MAX_BATCH queries. Queries with
+    different sampling parameters are run as separate batches, and
+    each of those is split by prompt length (see bucket_by_length).
+
+    Args:
+        app (FastAPI): The application holding the queue and model.
+    """
+    loop = asyncio.get_running_loop()
+    inbox: asyncio.Queue = app.state.inbox
+    while True:
+        batch = [await inbox.get()]
+        deadline = loop.time() + BATCH_WAIT
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(await asyncio.wait_for(inbox.get(),
+                                                    deadline - loop.time()))
+            except asyncio.TimeoutError:
+                break
+
+        groups: dict[tuple[int, float, float], list] = {}
+        for query, future in batch:
+            key = (query.max_length, query.temperature, query.top_p)
+            groups.setdefault(key, []).append((query, future))
+        for group in groups.values():
+            try:
+                # Measured on the inference thread: the tokenizer is
+                # not safe to use from two threads at once.
+                buckets = await on_model(app,
+                                         partial(bucket_by_length, batch = group))
+                for bucket in buckets:
+                    await run_batch(app, bucket)
+            except Exception as e:
+                # Fail this group's queries but keep serving the queue.
+                logger.exception("Error running batch")
+                for _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
 
 # --- API Endpoints ---
 
+# Clients send the API key in the X-API-Key header.
+api_key_header = APIKeyHeader(name = "X-API-Key",
+                              auto_error = False)
+
+async def require_api_key(api_key: str | None = Security(api_key_header)) -> None:
+    """
+    Rejects a request whose API key does not match API_KEY.
+
+    Every request is accepted when no API_KEY is configured. The keys
+    are compared in constant time so a wrong key cannot be guessed
+    byte by byte from response times.
+
+    Args:
+        api_key (str | None): The X-API-Key header, if sent.
+
+    Raises:
+        HTTPException: 401 Unauthorized if the API key is missing or incorrect.
+    """
+    if API_KEY and not hmac.compare_digest((api_key or "").encode(),
+                                           API_KEY.encode()):
+        raise HTTPException(status_code = 401,
+                            detail = "Unauthorized API key provided.")
+
 @app.get("/")
 async def root():
     """
@@ -136,42 +975,131 @@ async def health_check():
     """
     return {"status": "ok"}
 
-@app.post("/generate")
-async def generate_text(query: Query,
-                        api_key: str = ''):
+@app.post("/generate",
+          dependencies = [Depends(require_api_key)])
+async def generate_text(request: Request,
+                        query: Query):
     """
     Generates text based on the provided prompt.
 
     Args:
+        request (Request): The incoming request, used to reach the loaded model.
         query (Query): The input query containing the prompt and parameters.
-        api_key (str, optional):  The API key for authentication.
-        Defaults to the value of the environment variable API_KEY.
 
     Returns:
         dict: A dictionary containing the prompt and the generated response.
 
     Raises:
-        HTTPException: 401 Unauthorized if the API key is incorrect.
+        HTTPException: 401 Unauthorized if the API key is missing or incorrect.
         HTTPException: 500 Internal Server Error if text generation fails.
+        HTTPException: 503 Service Unavailable if the last reload failed.
     """
-    # Check and compare with API_KEY from the environment
-    if api_key and api_key != API_KEY:
-        raise HTTPException(status_code = 401,
-                            detail = "Unauthorized API key provided.")
-
     try:
-        llm_pipeline: Pipeline = load_model(MODEL_NAME)
-        output = llm_pipeline(
-            query.prompt,
-            max_length = query.max_length,
-            temperature = query.temperature,
-            top_p = query.top_p,
-        )
+        if BACKEND == "vllm":
+            engine = await on_model(request.app, lambda engine: engine)
+            response = await generate_with_engine(engine, query)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            await request.app.state.inbox.put((query, future))
+            response = await future
         return {
             "prompt": query.prompt,
-            "response": output[0]["generated_text"],
+            "response": response,
         }
+    except ModelUnavailable as e:
+        raise HTTPException(status_code = 503,
+                            detail = "No model loaded; the last reload failed.") from e
     except Exception as e:
         logger.exception("Error generating text")
         raise HTTPException(status_code = 500,
                             detail = "Failed to generate text.") from e
+
+@app.post("/stream",
+          dependencies = [Depends(require_api_key)])
+async def stream_text(request: Request,
+                      query: Query):
+    """
+    Streams text generated from the provided prompt.
+
+    The completion is sent as plain text while it is being
+    generated, rather than once generation has finished.
+
+    Args:
+        request (Request): The incoming request, used to reach the loaded model.
+        query (Query): The input query containing the prompt and parameters.
+
+    Returns:
+        StreamingResponse: The completion, as plain text.
+
+    Raises:
+        HTTPException: 401 Unauthorized if the API key is missing or incorrect.
+        HTTPException: 500 Internal Server Error if streaming cannot start.
+        HTTPException: 503 Service Unavailable if the last reload failed.
+    """
+    try:
+        if BACKEND == "vllm":
+            engine = await on_model(request.app, lambda engine: engine)
+            chunks = stream_with_engine(engine, query)
+        else:
+            chunks = await on_model(
+                request.app,
+                lambda llm: llm.stream(
+                    query.prompt,
+                    request.app.state.pool,
+                    max_new_tokens = query.max_length,
+                    temperature = query.temperature,
+                    top_p = query.top_p,
+                    )
+                )
+        return StreamingResponse(chunks,
+                                 media_type = "text/plain")
+    except ModelUnavailable as e:
+        raise HTTPException(status_code = 503,
+                            detail = "No model loaded; the last reload failed.") from e
+    except Exception as e:
+        logger.exception("Error streaming text")
+        raise HTTPException(status_code = 500,
+                            detail = "Error streaming text.") from e
+
+@app.post("/reload",
+          dependencies = [Depends(require_api_key)])
+async def reload(request: Request):
+    """
+    Reloads the model, e.g. after its weights have been updated.
+
+    Queries that arrive during the reload wait for the new model.
+    Only available when SHYLLM_API_KEY is set, since a reload takes
+    generation offline for as long as the model takes to load.
+
+    Args:
+        request (Request): The incoming request, used to reach the worker pool.
+
+    Returns:
+        dict: A dictionary containing the status and the reloaded model name.
+
+    Raises:
+        HTTPException: 401 Unauthorized if the API key is missing or incorrect.
+        HTTPException: 403 Forbidden if no SHYLLM_API_KEY is configured.
+        HTTPException: 409 Conflict on the vLLM backend, which cannot reload.
+        HTTPException: 500 Internal Server Error if the model fails to load.
+    """
+    if not API_KEY:
+        raise HTTPException(status_code = 403,
+                            detail = "Set SHYLLM_API_KEY to enable reloading.")
+    if BACKEND == "vllm":
+        # The old engine would keep its share of GPU memory and
+        # the new one could never allocate its own.
+        raise HTTPException(status_code = 409,
+                            detail = "Reloading is not supported on the vllm backend; restart the server instead.")
+
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            request.app.state.pool,
+            reload_model
+            )
+        await on_model(request.app, warm_up)
+    except Exception as e:
+        logger.exception("Error reloading model")
+        raise HTTPException(status_code = 500,
+                            detail = "Failed to reload model.") from e
+    return {"status": "reloaded", "model": MODEL_NAME}